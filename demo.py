@@ -2,20 +2,53 @@
 Demo script showing how to use the Kubernetes-like orchestration system.
 """
 
-import subprocess
+import sys
 import time
-from k4s import KissCluster
+import docker
+from concurrent.futures import as_completed
+from k4s import KissCluster, loadbalancer_name
 
+# Manifests shared by demo_scaling, hoisted so repeated applies hit the parse cache
+_ECHO_TEMPLATE_YAML = """
+kind: Container
+metadata:
+  name: echo-template
+spec:
+  module: workers
+  function: echo_worker
+  parameters:
+    prefix: "REPLICA"
+"""
+
+
+def _echo_rs(replicas: int) -> dict:
+    """The echo-rs ReplicaSet as an already-parsed manifest"""
+    return {
+        "kind": "ReplicaSet",
+        "metadata": {"name": "echo-rs"},
+        "spec": {"container": "echo-template", "replicas": replicas},
+    }
 
-def demo_basic_container():
+
+def print_cluster_state(client: docker.DockerClient, log_tail: int = 200):
+    """Show the cluster's containers and the tail of the ping container's logs"""
+    for container in client.containers.list(
+        filters={"network": KissCluster.network_name}
+    ):
+        print(f"{container.name}: {container.status}")
+    sys.stdout.flush()
+    logs = client.containers.get("ping").logs(stream=True, follow=False, tail=log_tail)
+    for line in logs:
+        sys.stdout.buffer.write(line)
+    sys.stdout.flush()
+
+
+def demo_basic_container(cluster: KissCluster):
     """Demo 1: Basic container deployment"""
     print("\n" + "=" * 60)
     print("DEMO 1: Basic Container Deployment")
     print("=" * 60)
 
-    cluster = KissCluster()
-    cluster.start()
-
     # Deploy a simple echo container
     yaml_content = """
 kind: Container
@@ -26,7 +59,7 @@ spec:
 """
 
     cluster.apply_yaml(yaml_content)
-    time.sleep(2)
+    cluster.wait_ready("echo-1")
 
     # Send messages to the container
     print("\nSending messages to echo-1...")
@@ -44,17 +77,14 @@ spec:
     # print(f"Received response: {response}")
 
     time.sleep(1)
-    cluster.stop()
+    cluster.delete_yaml(yaml_content)
 
 
-def demo_network():
+def demo_network(cluster: KissCluster):
     print("\n" + "=" * 60)
     print("DEMO: Two containers that talk to each other")
     print("=" * 60)
 
-    cluster = KissCluster()
-    cluster.start()
-
     # Deploy a simple echo container
     yaml_content = """
 kind: Container
@@ -74,23 +104,21 @@ spec:
 
     try:
         cluster.apply_yaml(yaml_content)
-        time.sleep(5)
-        print(subprocess.check_output(["docker", "ps"]))
-        print(subprocess.check_output(["docker", "logs", "ping"]))
+        cluster.wait_ready("health", "ping")
+        # Give ping time to log a few health checks
+        time.sleep(2)
+        print_cluster_state(cluster.docker)
         input("Press [Enter] to continue")
     finally:
-        cluster.stop()
+        cluster.delete_yaml(yaml_content)
 
 
-def demo_replicaset():
+def demo_replicaset(cluster: KissCluster):
     """Demo 2: ReplicaSet with multiple replicas"""
     print("\n" + "=" * 60)
     print("DEMO 2: ReplicaSet with Load Balancing")
     print("=" * 60)
 
-    cluster = KissCluster()
-    cluster.start()
-
     # Deploy container template and replicaset
     yaml_content = """
 kind: ReplicaSet
@@ -120,96 +148,62 @@ spec:
 
     try:
         cluster.apply_yaml(yaml_content)
-        time.sleep(5)
-        print(subprocess.check_output(["docker", "ps"]))
-        print(subprocess.check_output(["docker", "logs", "ping"]))
+        cluster.wait_ready(
+            "health-rs-0",
+            "health-rs-1",
+            "health-rs-2",
+            "ping",
+            loadbalancer_name("health-service"),
+        )
+        # Give ping time to log a few health checks
+        time.sleep(2)
+        print_cluster_state(cluster.docker)
         input("Press [Enter] to continue")
     finally:
-        cluster.stop()
+        cluster.delete_yaml(yaml_content)
 
 
-def demo_scaling():
+def demo_scaling(cluster: KissCluster):
     """Demo 3: Dynamic scaling"""
     print("\n" + "=" * 60)
     print("DEMO 3: Dynamic Scaling")
     print("=" * 60)
 
-    cluster = KissCluster()
-    cluster.start()
+    def replicas():
+        return len(cluster.list_names("Container", name_prefix="echo-rs-"))
 
     # Deploy with 2 replicas
-    yaml_content = """
-kind: Container
-metadata:
-  name: echo-template
-spec:
-  module: workers
-  function: echo_worker
-  parameters:
-    prefix: "REPLICA"
----
-kind: ReplicaSet
-metadata:
-  name: echo-rs
-spec:
-  container: echo-template
-  replicas: 2
-"""
+    cluster.apply_yaml(_ECHO_TEMPLATE_YAML)
+    cluster.apply_resources([_echo_rs(2)])
+    cluster.wait_for(lambda: replicas() == 2)
 
-    cluster.apply_yaml(yaml_content)
-    time.sleep(3)
-
-    print(
-        f"\nInitial replicas: {len([c for c in cluster.list_resources('Container') if c.name.startswith('echo-rs-')])}"
-    )
+    print(f"\nInitial replicas: {replicas()}")
 
     # Scale up to 5
     print("\nScaling up to 5 replicas...")
-    yaml_content = """
-kind: ReplicaSet
-metadata:
-  name: echo-rs
-spec:
-  container: echo-template
-  replicas: 5
-"""
-    cluster.apply_yaml(yaml_content)
-    time.sleep(3)
+    cluster.apply_resources([_echo_rs(5)])
+    cluster.wait_for(lambda: replicas() == 5)
 
-    print(
-        f"After scale up: {len([c for c in cluster.list_resources('Container') if c.name.startswith('echo-rs-')])}"
-    )
+    print(f"After scale up: {replicas()}")
 
     # Scale down to 2
     print("\nScaling down to 2 replicas...")
-    yaml_content = """
-kind: ReplicaSet
-metadata:
-  name: echo-rs
-spec:
-  container: echo-template
-  replicas: 2
-"""
-    cluster.apply_yaml(yaml_content)
-    time.sleep(3)
+    cluster.apply_resources([_echo_rs(2)])
+    cluster.wait_for(lambda: replicas() == 2)
 
-    print(
-        f"After scale down: {len([c for c in cluster.list_resources('Container') if c.name.startswith('echo-rs-')])}"
-    )
+    print(f"After scale down: {replicas()}")
 
     time.sleep(1)
-    cluster.stop()
+    cluster.delete_resource("ReplicaSet", "echo-rs")
+    cluster.delete_yaml(_ECHO_TEMPLATE_YAML)
 
 
-def demo_inter_container_communication():
+def demo_inter_container_communication(cluster: KissCluster):
     """Demo 4: Containers communicating with each other"""
     print("\n" + "=" * 60)
     print("DEMO 4: Inter-Container Communication")
     print("=" * 60)
 
-    cluster = KissCluster()
-    cluster.start()
-
     # Deploy processor that forwards to aggregator
     yaml_content = """
 kind: Container
@@ -233,27 +227,22 @@ spec:
 """
 
     cluster.apply_yaml(yaml_content)
-    time.sleep(2)
+    cluster.wait_ready("aggregator", "processor")
 
     # Send messages to processor, which will forward to aggregator
     print("\nSending messages to processor (which forwards to aggregator)...")
-    for i in range(5):
-        cluster.api.send_to_container("processor", f"test-{i}")
-        time.sleep(0.5)
+    cluster.api.send_paced("processor", [f"test-{i}" for i in range(5)], rate_hz=2)
 
     time.sleep(2)
-    cluster.stop()
+    cluster.delete_yaml(yaml_content)
 
 
-def demo_generator_pipeline():
+def demo_generator_pipeline(cluster: KissCluster):
     """Demo 5: Generator -> Processor pipeline"""
     print("\n" + "=" * 60)
     print("DEMO 5: Generator -> Service Pipeline")
     print("=" * 60)
 
-    cluster = KissCluster()
-    cluster.start()
-
     # Deploy processor replicaset and service
     yaml_content = """
 kind: Container
@@ -295,18 +284,15 @@ spec:
     print("\nGenerator will send messages to processor service...")
     time.sleep(8)
 
-    cluster.stop()
+    cluster.delete_yaml(yaml_content)
 
 
-def demo_calculator_service():
+def demo_calculator_service(cluster: KissCluster):
     """Demo 6: Request-response calculator service"""
     print("\n" + "=" * 60)
     print("DEMO 6: Calculator Request-Response Service")
     print("=" * 60)
 
-    cluster = KissCluster()
-    cluster.start()
-
     yaml_content = """
 kind: Container
 metadata:
@@ -331,7 +317,7 @@ spec:
 """
 
     cluster.apply_yaml(yaml_content)
-    time.sleep(2)
+    cluster.wait_ready("calculator-rs-0", "calculator-rs-1", "calculator-rs-2")
 
     # Make calculation requests
     print("\nMaking calculation requests to calculator service...")
@@ -342,25 +328,24 @@ spec:
         {"operation": "average", "operands": [10, 20, 30, 40]},
     ]
 
-    for req in requests:
-        future = cluster.api.send_to_service("calculator", req, expect_response=True)
-        result = future.result(timeout=5)
-        print(f"Request: {req} -> Result: {result}")
-        time.sleep(0.5)
+    futures = cluster.api.send_many_to_service(
+        "calculator", requests, expect_response=True
+    )
+    # Report each result as soon as its replica answers
+    pending = dict(zip(futures, requests))
+    for future in as_completed(pending, timeout=5):
+        print(f"Request: {pending[future]} -> Result: {future.result()}")
 
     time.sleep(1)
-    cluster.stop()
+    cluster.delete_yaml(yaml_content)
 
 
-def demo_resource_crud():
+def demo_resource_crud(cluster: KissCluster):
     """Demo 7: CRUD operations on resources"""
     print("\n" + "=" * 60)
     print("DEMO 7: Resource CRUD Operations")
     print("=" * 60)
 
-    cluster = KissCluster()
-    cluster.start()
-
     # Create
     print("\n1. Creating resources...")
     yaml_content = """
@@ -374,7 +359,7 @@ spec:
     prefix: "TEST"
 """
     cluster.apply_yaml(yaml_content)
-    time.sleep(1)
+    cluster.wait_ready("test-container")
 
     # Read
     print("\n2. Reading resource...")
@@ -403,15 +388,15 @@ spec:
     # Delete
     print("\n4. Deleting resource...")
     cluster.delete_resource("Container", "test-container")
-    time.sleep(2)
+    cluster.wait_for(
+        lambda: cluster.container_controller.get_container("test-container") is None
+    )
 
     # Verify deletion
     print("\n5. Verifying deletion...")
     resource = cluster.get_resource("Container", "test-container")
     print(f"   Resource exists: {resource is not None}")
 
-    cluster.stop()
-
 
 def run_all_demos():
     """Run all demos"""
@@ -426,18 +411,27 @@ def run_all_demos():
         # demo_resource_crud,
     ]
 
-    for demo in demos:
-        try:
-            demo()
-            time.sleep(2)
-        except KeyboardInterrupt:
-            print("\nDemo interrupted by user")
-            break
-        except Exception as e:
-            print(f"\nDemo error: {e}")
-            import traceback
-
-            traceback.print_exc()
+    # One cluster for all demos: each demo removes its own resources on exit
+    cluster = KissCluster()
+    cluster.start()
+
+    try:
+        for demo in demos:
+            try:
+                demo(cluster)
+            except KeyboardInterrupt:
+                print("\nDemo interrupted by user")
+                break
+            except Exception as e:
+                print(f"\nDemo error: {e}")
+                import traceback
+
+                traceback.print_exc()
+            # Let the controllers tear down this demo's containers; if they
+            # can't, stop rather than run the next demo alongside them
+            cluster.wait_for(lambda: not cluster.container_controller.list_containers())
+    finally:
+        cluster.stop()
 
 
 if __name__ == "__main__":
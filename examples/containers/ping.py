@@ -1,31 +1,46 @@
-import requests
+import asyncio
+import aiohttp
 import time
-from datetime import datetime
 import os
 
+try:
+    from orjson import loads
+except ImportError:
+    from json import loads
+
+# Comma-separated list of host:port pairs to check
 HEALTH_SERVICE = os.environ["HEALTH_SERVICE"]
-HEALTH_URL = f"http://{HEALTH_SERVICE}/health"
+HEALTH_URLS = [f"http://{service}/health" for service in HEALTH_SERVICE.split(",")]
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+TIMEOUT = aiohttp.ClientTimeout(total=2)
 
+SUCCESS_TMPL = "[%s] ✓ SUCCESS - Health check passed: %s"
+STATUS_FAILURE_TMPL = "[%s] ✗ FAILURE - Status code: %s"
+ERROR_FAILURE_TMPL = "[%s] ✗ FAILURE - Error: %s"
 
-def check_health():
-    while True:
-        try:
-            response = requests.get(HEALTH_URL, timeout=2)
-            timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
-            if response.status_code == 200:
-                print(
-                    f"[{timestamp}] ✓ SUCCESS - Health check passed: {response.json()}"
-                )
+async def check_one(session: aiohttp.ClientSession, url: str, timestamp: str):
+    try:
+        async with session.get(url) as response:
+            if response.status == 200:
+                print(SUCCESS_TMPL % (timestamp, await response.json(loads=loads)))
             else:
-                print(f"[{timestamp}] ✗ FAILURE - Status code: {response.status_code}")
-        except requests.exceptions.RequestException as e:
-            timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            print(f"[{timestamp}] ✗ FAILURE - Error: {str(e)}")
+                print(STATUS_FAILURE_TMPL % (timestamp, response.status))
+    except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+        # ValueError covers malformed bodies: json's and orjson's JSONDecodeError
+        print(ERROR_FAILURE_TMPL % (timestamp, e))
+
 
-        time.sleep(1)
+async def check_health():
+    async with aiohttp.ClientSession(timeout=TIMEOUT) as session:
+        while True:
+            timestamp = time.strftime(TIMESTAMP_FORMAT)
+            await asyncio.gather(
+                *(check_one(session, url, timestamp) for url in HEALTH_URLS)
+            )
+            await asyncio.sleep(1)
 
 
 if __name__ == "__main__":
     print(f"Starting health checker against {HEALTH_SERVICE}...")
-    check_health()
+    asyncio.run(check_health())
@@ -9,20 +9,33 @@ This demo implements:
 - External API for interacting with containers
 """
 
-import json
-import subprocess
 import threading
 import traceback
+import docker
 import httpx
 import yaml
+import contextlib
 import fnmatch
-import random
+import functools
+import heapq
+import operator
+import itertools
+import queue
+import re
 import time
-from typing import Dict, Iterable, List, Any, Optional
+import types
+from typing import Callable, Dict, Iterable, Iterator, List, Any, Optional, Set, Tuple
+from collections import defaultdict
+from collections.abc import Mapping
 from dataclasses import dataclass, field
-from concurrent.futures import Future
+from concurrent.futures import Future, ThreadPoolExecutor
 from enum import Enum
 
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:  # PyYAML built without libyaml
+    from yaml import SafeLoader
+
 
 class ResourceType(Enum):
     CONTAINER = "container"
@@ -30,7 +43,7 @@ class ResourceType(Enum):
     SERVICE = "service"
 
 
-@dataclass
+@dataclass(slots=True)
 class Resource:
     """Base resource class"""
 
@@ -42,11 +55,17 @@ class Resource:
 
 @dataclass
 class ContainerResource(Resource):
-    """Container resource definition"""
+    """Container resource definition; its spec is read-only once created"""
+
+    __slots__ = ()
 
     def __init__(
         self, name: str, spec: Dict[str, Any], metadata: Dict[str, Any] = None
     ):
+        # Specs are shared (between replicas, and with cached manifests), so
+        # updates apply a new resource instead of mutating this one
+        if not isinstance(spec, types.MappingProxyType):
+            spec = types.MappingProxyType(spec)
         super().__init__(
             kind="Container", name=name, spec=spec, metadata=metadata or {}
         )
@@ -68,6 +87,8 @@ class ContainerResource(Resource):
 class ReplicaSetResource(Resource):
     """ReplicaSet resource definition"""
 
+    __slots__ = ()
+
     def __init__(
         self, name: str, spec: Dict[str, Any], metadata: Dict[str, Any] = None
     ):
@@ -79,6 +100,11 @@ class ReplicaSetResource(Resource):
     def container_spec(self) -> dict:
         return self.spec.get("spec")
 
+    @property
+    def template(self) -> Optional[str]:
+        """Name of the Container whose spec replicas copy, if no spec is inline"""
+        return self.spec.get("container")
+
     @property
     def replicas(self) -> int:
         return self.spec.get("replicas", 1)
@@ -88,6 +114,8 @@ class ReplicaSetResource(Resource):
 class ServiceResource(Resource):
     """Service resource definition"""
 
+    __slots__ = ()
+
     def __init__(
         self, name: str, spec: Dict[str, Any], metadata: Dict[str, Any] = None
     ):
@@ -97,6 +125,10 @@ class ServiceResource(Resource):
     def selector(self) -> str:
         return self.spec.get("selector")
 
+    @property
+    def selector_pattern(self) -> re.Pattern:
+        return _compiled_selector(self.selector)
+
     @property
     def source_port(self) -> int:
         return self.spec.get("port")
@@ -110,6 +142,7 @@ class ServiceResource(Resource):
         return loadbalancer_name(self.name)
 
 
+@functools.lru_cache(maxsize=1024)
 def loadbalancer_name(service_name: str) -> str:
     return "service-lb-" + service_name
 
@@ -124,16 +157,23 @@ class Container:
         entrypoint: str,
         env: Dict[str, Any],
         api_client: "KissAPI",
+        docker_client: docker.DockerClient,
         ports: Optional[List[Dict[str, int]]] = None,
     ):
         assert image is not None
         self.name = name
         self.image = image
         self.entrypoint = entrypoint
-        assert isinstance(env, dict)
-        self.env = env
+        assert isinstance(env, Mapping)
+        # docker-py only formats a real dict as environment variables
+        self.env = dict(env)
         self.ports = ports
         self.api_client = api_client
+        # Unbounded and lock-free in CPython; workers only need put/get
+        self.input_queue: queue.SimpleQueue = queue.SimpleQueue()
+        self.docker_client = docker_client
+        self.docker_container = None
+        self.ip: Optional[str] = None
         self.running = False
 
     def start(self):
@@ -141,47 +181,102 @@ class Container:
         if self.running:
             return
 
-        command = (
-            [
-                "docker",
-                "container",
-                "run",
-                "--name=" + self.name,
-                #  "--label", com.example.key=value
-                "--network=k4s",
-                # --dns=X.X.X.X,
-                "--detach",
-            ]
-            + flatten([("--env", f"{k}={v}") for k, v in self.env.items()])
-            + (
-                ["--entrypoint=" + self.entrypoint]
-                if self.entrypoint is not None
-                else []
-            )
-            + flatten(
-                [
-                    ("-p", f"{port['hostPort']}:{port['containerPort']}")
-                    for port in (self.ports or ())
-                ]
-            )
-            + [self.image]
+        self.docker_container = self.docker_client.containers.run(
+            self.image,
+            name=self.name,
+            network="k4s",
+            detach=True,
+            environment=self.env,
+            entrypoint=self.entrypoint,
+            ports={
+                f"{port['containerPort']}/tcp": port["hostPort"]
+                for port in (self.ports or ())
+            },
         )
-        print(command)
-        subprocess.check_call(command)
+        # run() returns the container as created; its network has no IP until
+        # it is inspected again after starting
+        self.docker_container.reload()
+        networks = self.docker_container.attrs["NetworkSettings"]["Networks"]
+        self.ip = networks["k4s"]["IPAddress"]
         self.running = True
 
     def stop(self):
         """Stop the container thread"""
         self.running = False
-        subprocess.check_call(
-            [
-                "docker",
-                "container",
-                "rm",
-                "--force",
-                self.name,
-            ]
-        )
+        if self.docker_container is not None:
+            self.docker_container.remove(force=True)
+
+
+class RWLock:
+    """Readers-writer lock: any number of concurrent readers, or one writer.
+
+    Waiting writers hold off new readers, so a steady stream of reads can't
+    starve them. Not reentrant.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)
+        self._readers = 0
+        self._writer = False
+        self._writers_waiting = 0
+        # Guards are stateless, so every with-block can share the same two
+        self._read = _ReadGuard(self)
+        self._write = _WriteGuard(self)
+
+    def read(self) -> "_ReadGuard":
+        return self._read
+
+    def write(self) -> "_WriteGuard":
+        return self._write
+
+
+class _ReadGuard:
+    """Shared side of an RWLock"""
+
+    __slots__ = ("rw",)
+
+    def __init__(self, rw: RWLock):
+        self.rw = rw
+
+    def __enter__(self):
+        rw = self.rw
+        with rw._lock:
+            while rw._writer or rw._writers_waiting:
+                rw._cond.wait()
+            rw._readers += 1
+
+    def __exit__(self, *exc_info):
+        rw = self.rw
+        with rw._lock:
+            rw._readers -= 1
+            # Only a writer can be waiting on readers to finish
+            if not rw._readers and rw._writers_waiting:
+                rw._cond.notify_all()
+
+
+class _WriteGuard:
+    """Exclusive side of an RWLock"""
+
+    __slots__ = ("rw",)
+
+    def __init__(self, rw: RWLock):
+        self.rw = rw
+
+    def __enter__(self):
+        rw = self.rw
+        with rw._lock:
+            rw._writers_waiting += 1
+            while rw._writer or rw._readers:
+                rw._cond.wait()
+            rw._writers_waiting -= 1
+            rw._writer = True
+
+    def __exit__(self, *exc_info):
+        rw = self.rw
+        with rw._lock:
+            rw._writer = False
+            rw._cond.notify_all()
 
 
 class ResourceStore:
@@ -193,201 +288,622 @@ class ResourceStore:
             "ReplicaSet": {},
             "Service": {},
         }
-        self.lock = threading.RLock()
+        self.watchers: Dict[str, List[Callable[[], None]]] = {
+            kind: [] for kind in self.resources
+        }
+        # Names of the resources of each kind owned by each ReplicaSet
+        self._by_owner: Dict[str, Dict[str, Set[str]]] = {
+            kind: defaultdict(set) for kind in self.resources
+        }
+        # Controllers and the API list/get far more often than anything writes.
+        # Each kind has its own lock, so work on one kind never blocks another.
+        self.locks: Dict[str, RWLock] = {kind: RWLock() for kind in self.resources}
+        # Unknown kinds hold no resources; this just keeps lookups uniform
+        self._unknown_kind_lock = RWLock()
+        # Bumped on every change to a kind, so readers can tell when to recompute
+        self.versions: Dict[str, int] = {kind: 0 for kind in self.resources}
+        # Every resource of each kind, republished on change so that unfiltered
+        # lists need neither the lock nor a copy
+        self._snapshots: Dict[str, Tuple[Resource, ...]] = {
+            kind: () for kind in self.resources
+        }
+
+    def _lock(self, kind: str) -> RWLock:
+        return self.locks.get(kind, self._unknown_kind_lock)
+
+    def watch(self, kind: str, callback: Callable[[], None]):
+        """Call callback after every change to resources of a kind"""
+        with self.locks[kind].write():
+            self.watchers[kind].append(callback)
+
+    def _notify(self, kind: str):
+        self._snapshots[kind] = tuple(self.resources[kind].values())
+        self.versions[kind] += 1
+        for callback in self.watchers.get(kind, ()):
+            callback()
 
     def create(self, resource: Resource) -> Resource:
         """Create a resource"""
-        with self.lock:
+        with self.locks[resource.kind].write():
             if resource.name in self.resources[resource.kind]:
                 raise ValueError(f"{resource.kind} {resource.name} already exists")
             self.resources[resource.kind][resource.name] = resource
+            self._index(resource)
+            self._notify(resource.kind)
             return resource
 
+    def create_many(self, resources: List[Resource]):
+        """Create resources of one kind under a single write lock, all or none"""
+        kinds = {resource.kind for resource in resources}
+        if len(kinds) != 1:
+            raise ValueError(f"create_many needs resources of one kind, got {kinds}")
+        (kind,) = kinds
+        with self.locks[kind].write():
+            existing = self.resources[kind]
+            for resource in resources:
+                if resource.name in existing:
+                    raise ValueError(f"{kind} {resource.name} already exists")
+            for resource in resources:
+                existing[resource.name] = resource
+                self._index(resource)
+            self._notify(kind)
+
     def get(self, kind: str, name: str) -> Optional[Resource]:
         """Get a resource by kind and name"""
-        with self.lock:
+        with self._lock(kind).read():
             return self.resources.get(kind, {}).get(name)
 
-    def list(self, kind: str) -> List[Resource]:
-        """List all resources of a kind"""
-        with self.lock:
-            return list(self.resources.get(kind, {}).values())
+    def list(
+        self,
+        kind: str,
+        name_prefix: Optional[str] = None,
+        selector: Optional[str] = None,
+    ) -> Tuple[Resource, ...]:
+        """List resources of a kind, optionally filtered by name prefix or glob"""
+        if name_prefix is None and selector is None:
+            return self._snapshots.get(kind, ())
+        with self._lock(kind).read():
+            resources = self.resources.get(kind, {})
+            names: Iterable[str] = resources
+            if selector is not None and _GLOB_CHARS.isdisjoint(selector):
+                # A plain name: look it up instead of matching every name
+                names = (selector,) if selector in resources else ()
+                selector = None
+            if name_prefix is not None:
+                names = filter(operator.methodcaller("startswith", name_prefix), names)
+            if selector is not None:
+                names = filter(_compiled_selector(selector).match, names)
+            return tuple(resources[name] for name in names)
+
+    def list_owned(self, kind: str, owner: str) -> List[Resource]:
+        """List resources of a kind owned by the named ReplicaSet"""
+        with self._lock(kind).read():
+            resources = self.resources.get(kind, {})
+            owned = self._by_owner.get(kind, {}).get(owner, ())
+            return [resources[name] for name in owned]
+
+    def owners(self, kind: str) -> Tuple[str, ...]:
+        """List the ReplicaSets that own at least one resource of a kind"""
+        with self._lock(kind).read():
+            return tuple(self._by_owner.get(kind, ()))
+
+    def names(self, kind: str, name_prefix: Optional[str] = None) -> Tuple[str, ...]:
+        """List the names of resources of a kind, optionally filtered by prefix"""
+        with self._lock(kind).read():
+            names = self.resources.get(kind, {})
+            if name_prefix is None:
+                return tuple(names)
+            return tuple(
+                filter(operator.methodcaller("startswith", name_prefix), names)
+            )
 
     def update(self, resource: Resource) -> Resource:
         """Update a resource"""
-        with self.lock:
+        with self.locks[resource.kind].write():
             if resource.name not in self.resources[resource.kind]:
                 raise ValueError(f"{resource.kind} {resource.name} does not exist")
+            self._unindex(self.resources[resource.kind][resource.name])
             self.resources[resource.kind][resource.name] = resource
+            self._index(resource)
+            self._notify(resource.kind)
             return resource
 
+    def upsert_many(self, resources: Iterable[Resource]) -> List[bool]:
+        """Create or update resources, taking each kind's write lock only once.
+
+        Returns, for each resource, whether it was created rather than updated.
+        """
+        resources = list(resources)
+        kinds = sorted({resource.kind for resource in resources})
+        created = []
+        with contextlib.ExitStack() as stack:
+            # Always lock kinds in the same order, so batches can't deadlock
+            for kind in kinds:
+                stack.enter_context(self.locks[kind].write())
+            for resource in resources:
+                existing = self.resources[resource.kind].get(resource.name)
+                if existing is not None:
+                    self._unindex(existing)
+                self.resources[resource.kind][resource.name] = resource
+                self._index(resource)
+                created.append(existing is None)
+            for kind in kinds:
+                self._notify(kind)
+        return created
+
     def delete(self, kind: str, name: str) -> bool:
         """Delete a resource"""
-        with self.lock:
+        with self._lock(kind).write():
             if name in self.resources.get(kind, {}):
-                del self.resources[kind][name]
+                self._unindex(self.resources[kind].pop(name))
+                self._notify(kind)
                 return True
             return False
 
+    def delete_many(self, kind: str, names: Iterable[str]) -> int:
+        """Delete resources of a kind under a single write lock.
+
+        Returns how many of them existed.
+        """
+        deleted = 0
+        with self._lock(kind).write():
+            resources = self.resources.get(kind, {})
+            for name in names:
+                resource = resources.pop(name, None)
+                if resource is not None:
+                    self._unindex(resource)
+                    deleted += 1
+            if deleted:
+                self._notify(kind)
+        return deleted
+
+    def _index(self, resource: Resource):
+        owner = resource.metadata.get("replicaset")
+        if owner is not None:
+            self._by_owner[resource.kind][owner].add(resource.name)
+
+    def _unindex(self, resource: Resource):
+        owner = resource.metadata.get("replicaset")
+        if owner is not None:
+            owned = self._by_owner[resource.kind][owner]
+            owned.discard(resource.name)
+            if not owned:
+                del self._by_owner[resource.kind][owner]
+
+
+# Seconds between reconciles when nothing changes, as a safety net for missed events
+RESYNC_PERIOD = 30
+# Seconds before retrying a reconcile that failed or asked to be requeued
+RETRY_PERIOD = 1
+
+
+class Scheduler:
+    """Runs controller reconciles on a single thread, soonest due first"""
+
+    def __init__(self):
+        self.running = False
+        self.thread = None
+        self._cond = threading.Condition()
+        self._heap: List[Tuple[float, int, "Controller"]] = []
+        # Earliest pending due time per controller; heap entries that don't
+        # match it have been superseded and are skipped
+        self._due: Dict["Controller", float] = {}
+        self._seq = itertools.count()
+
+    def start(self):
+        """Start the scheduler thread"""
+        with self._cond:
+            if self.running:
+                return
+            self.running = True
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """Stop the scheduler thread"""
+        with self._cond:
+            self.running = False
+            self._cond.notify()
+        if self.thread:
+            self.thread.join(timeout=5)
+
+    def schedule(self, controller: "Controller", delay: float = 0):
+        """Reconcile controller after delay seconds, unless it is already due sooner"""
+        due = time.monotonic() + delay
+        with self._cond:
+            if self._due.get(controller, due + 1) <= due:
+                return
+            self._due[controller] = due
+            heapq.heappush(self._heap, (due, next(self._seq), controller))
+            self._cond.notify()
+
+    def cancel(self, controller: "Controller"):
+        """Drop any pending reconcile of controller"""
+        with self._cond:
+            self._due.pop(controller, None)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self.running:
+                    if self._heap:
+                        due, _, controller = self._heap[0]
+                        timeout = due - time.monotonic()
+                        if timeout <= 0:
+                            break
+                    else:
+                        timeout = None
+                    self._cond.wait(timeout=timeout)
+                if not self.running:
+                    return
+                heapq.heappop(self._heap)
+                if self._due.get(controller) != due:
+                    continue
+                del self._due[controller]
+            delay = controller._reconcile_pass()
+            if delay is not None:
+                self.schedule(controller, delay)
+
 
 class Controller:
     """Base controller class"""
 
-    def __init__(self, kind: str, store: ResourceStore):
+    def __init__(
+        self,
+        kind: str,
+        store: ResourceStore,
+        watches: Iterable[str] = (),
+        scheduler: Optional[Scheduler] = None,
+    ):
         self.kind = kind
         self.store = store
         self.running = False
-        self.thread = None
+        self.started = False
+        # Controllers given no scheduler get a thread of their own
+        self._owns_scheduler = scheduler is None
+        self.scheduler = scheduler or Scheduler()
+        self.reconciled = threading.Condition()
+        self._pass_lock = threading.Lock()
+        self._retry = False
+        # Reconcile whenever our own kind, or any kind we read, changes. The
+        # controller itself is only started by the first resource of our kind.
+        store.watch(kind, self.wake)
+        for watched in watches:
+            store.watch(watched, self._schedule)
 
     def start(self):
         """Start the controller"""
         if self.running:
             return
         self.running = True
-        self.thread = threading.Thread(target=self._reconcile_loop, daemon=True)
-        self.thread.start()
+        self.started = True
+        self.scheduler.start()
+        self.scheduler.schedule(self)
 
     def stop(self):
-        """Stop the controller"""
+        """Stop the controller, then shut down everything it manages"""
+        if not self.running:
+            return
         self.running = False
-        if self.thread:
-            self.thread.join(timeout=5)
+        self.scheduler.cancel(self)
+        # Waits for a pass already running on the scheduler thread
+        with self._pass_lock:
+            print(f"Controller {self.__class__.__name__} shutting down all resources")
+            try:
+                self.reconcile([])
+            except Exception:
+                print(f"Controller {self.__class__.__name__} error:")
+                traceback.print_exc()
+            print(f"Controller {self.__class__.__name__} finished")
+        if self._owns_scheduler:
+            self.scheduler.stop()
+
+    def wake(self):
+        """Reconcile soon, starting the controller if it has never run"""
+        if not self.started:
+            self.start()
+        else:
+            self._schedule()
 
-    def _reconcile_loop(self):
-        """Main reconciliation loop"""
-        while self.running:
+    def _schedule(self):
+        if self.running:
+            self.scheduler.schedule(self)
+
+    def _reconcile_pass(self) -> Optional[float]:
+        """Reconcile once, returning the delay until the next pass.
+
+        None means there is nothing to resync, so wait for a watched change.
+        """
+        with self._pass_lock:
+            if not self.running:
+                return None
+            self._retry = False
+            resources = self.store.list(self.kind)
             try:
-                self.reconcile(self.store.list(self.kind))
+                self.reconcile(resources)
             except Exception:
                 print(f"Controller {self.__class__.__name__} error:")
                 traceback.print_exc()
-            time.sleep(1)
-        print(f"Controller {self.__class__.__name__} shutting down all resources")
-        self.reconcile([])
-        print(f"Controller {self.__class__.__name__} finished")
+                self.requeue()
+        with self.reconciled:
+            self.reconciled.notify_all()
+        if self._retry:
+            return RETRY_PERIOD
+        if resources:
+            return RESYNC_PERIOD
+        return None
 
     def reconcile(self, resources: list[Resource]):
         """Reconcile desired state with actual state"""
         raise NotImplementedError
 
+    def requeue(self):
+        """Reconcile again soon even if no resources change"""
+        self._retry = True
+
+    def wait_for(self, predicate: Callable[[], bool], timeout: float) -> bool:
+        """Wait until predicate holds, re-checking after each reconcile pass"""
+        with self.reconciled:
+            return self.reconciled.wait_for(predicate, timeout)
+
 
 class ContainerController(Controller):
     """Controller for Container resources"""
 
-    def __init__(self, store: ResourceStore, api_client: "KissAPI"):
-        super().__init__("Container", store)
+    def __init__(
+        self,
+        store: ResourceStore,
+        api_client: "KissAPI",
+        docker_client: docker.DockerClient,
+        scheduler: Optional[Scheduler] = None,
+    ):
+        super().__init__("Container", store, scheduler=scheduler)
         self.api_client = api_client
+        self.docker_client = docker_client
+        # Docker calls mostly wait on the daemon, so several can be in flight
+        self.pool = ThreadPoolExecutor(max_workers=8, thread_name_prefix="docker")
         self.containers: Dict[str, Container] = {}
-        self.lock = threading.RLock()
+        # IP address of each running container on the cluster network
+        self.ips: Dict[str, str] = {}
+        # Bumped whenever the set of running containers changes
+        self.version = 0
+        # The running containers, republished whenever version is bumped
+        self._snapshot: Tuple[Container, ...] = ()
+        # Containers whose removal failed, retried on later passes. They are
+        # no longer running, so they stay out of containers and the snapshot.
+        self._unstopped: Dict[str, Container] = {}
+        # The API reads the container map on every send; only reconcile writes it
+        self.lock = RWLock()
 
     def reconcile(self, resources: list[Resource]):
         """Ensure containers match their resource definitions"""
-        with self.lock:
-            # Get desired containers
-            container_resources: list[ContainerResource] = resources  # type: ignore
-            desired_containers: dict[str, ContainerResource] = {
-                r.name: r for r in container_resources
-            }
-
-            # Stop and remove containers that shouldn't exist
-            for name in list(self.containers.keys()):
-                if name not in desired_containers:
-                    print(f"Stopping container: {name}")
-                    self.containers[name].stop()
-                    del self.containers[name]
-
-            # Create or update containers
-            for name, resource in desired_containers.items():
-                if name not in self.containers:
-                    print(f"Starting container: {name}")
-                    container = Container(
-                        name=name,
-                        image=resource.image,
-                        entrypoint=resource.entrypoint,
-                        env=resource.env,
-                        api_client=self.api_client,
-                    )
-                    container.start()
-                    self.containers[name] = container
+        # Get desired containers
+        container_resources: list[ContainerResource] = resources  # type: ignore
+        desired_containers: dict[str, ContainerResource] = {
+            r.name: r for r in container_resources
+        }
+
+        # Only diff under the lock: docker calls take seconds, and readers on
+        # the send path must not wait for them
+        with self.lock.write():
+            stale = [
+                self.containers.pop(name)
+                for name in list(self.containers)
+                if name not in desired_containers
+            ]
+            for container in stale:
+                self.ips.pop(container.name, None)
+            if stale:
+                self.version += 1
+                self._snapshot = tuple(self.containers.values())
+            missing = [
+                resource
+                for name, resource in desired_containers.items()
+                if name not in self.containers
+            ]
+
+        # Stop and remove containers that shouldn't exist, retrying earlier failures
+        stopping = []
+        for container in stale:
+            print(f"Stopping container: {container.name}")
+            stopping.append((container, self.pool.submit(container.stop)))
+        for container in self._unstopped.values():
+            print(f"Retrying removal of container: {container.name}")
+            stopping.append((container, self.pool.submit(container.stop)))
+        self._unstopped = {}
+
+        failed = []
+        for container, future in stopping:
+            error = future.exception()
+            if error is not None:
+                self._unstopped[container.name] = container
+                failed.append(f"stop {container.name}: {error}")
+
+        # Create containers, starting them all concurrently
+        starting = []
+        for resource in missing:
+            if resource.name in self._unstopped:
+                # Its old container still holds the name; start once it's removed
+                continue
+            print(f"Starting container: {resource.name}")
+            container = Container(
+                name=resource.name,
+                image=resource.image,
+                entrypoint=resource.entrypoint,
+                env=resource.env,
+                api_client=self.api_client,
+                docker_client=self.docker_client,
+            )
+            starting.append((container, self.pool.submit(container.start)))
+
+        started = {}
+        for container, future in starting:
+            error = future.exception()
+            if error is None:
+                started[container.name] = container
+            else:
+                failed.append(f"start {container.name}: {error}")
+        with self.lock.write():
+            self.containers.update(started)
+            self.ips.update((name, c.ip) for name, c in started.items())
+            if started:
+                self.version += 1
+                self._snapshot = tuple(self.containers.values())
+        if failed:
+            raise RuntimeError(f"Failed to reconcile containers: {'; '.join(failed)}")
+
+    def stop(self):
+        """Stop the controller, then its docker worker threads"""
+        super().stop()
+        self.pool.shutdown()
 
     def get_container(self, name: str) -> Optional[Container]:
         """Get a running container by name"""
-        with self.lock:
+        with self.lock.read():
             return self.containers.get(name)
 
-    def list_containers(self) -> List[Container]:
+    def list_containers(self) -> Tuple[Container, ...]:
         """List all running containers"""
-        with self.lock:
-            return list(self.containers.values())
+        return self._snapshot
 
 
 class ReplicaSetController(Controller):
     """Controller for ReplicaSet resources"""
 
-    def __init__(self, store: ResourceStore):
-        super().__init__("ReplicaSet", store)
+    def __init__(self, store: ResourceStore, scheduler: Optional[Scheduler] = None):
+        super().__init__(
+            "ReplicaSet", store, watches=["Container"], scheduler=scheduler
+        )
+
+    def _replica_spec(
+        self, replicaset: ReplicaSetResource
+    ) -> Optional[types.MappingProxyType]:
+        """The spec for a ReplicaSet's replicas, inline or from its template"""
+        spec = replicaset.container_spec
+        if spec is None and replicaset.template is not None:
+            # The Container watch reconciles again once the template shows up
+            template = self.store.get("Container", replicaset.template)
+            if template is None:
+                print(
+                    f"ReplicaSet {replicaset.name} template container '{replicaset.template}' not found"
+                )
+                return None
+            spec = template.spec
+        if spec is None:
+            print(f"ReplicaSet {replicaset.name} has neither spec nor container")
+            return None
+        # Replicas never modify their spec, so all share one read-only view
+        if not isinstance(spec, types.MappingProxyType):
+            spec = types.MappingProxyType(spec)
+        return spec
 
     def reconcile(self, resources: list[Resource]):
         """Ensure replica containers match ReplicaSet definitions"""
+        # Collect every change first, then apply them in two batches
+        creates: List[Resource] = []
+        deletes: List[str] = []
         for replicaset in resources:
             assert isinstance(replicaset, ReplicaSetResource)
 
             # Find existing replicas
-            prefix = f"{replicaset.name}-"
-            existing_replicas = [
-                r
-                for r in self.store.list("Container")
-                if r.name.startswith(prefix)
-                and r.metadata.get("replicaset") == replicaset.name
-            ]
+            existing_replicas = self.store.list_owned("Container", replicaset.name)
 
             current_count = len(existing_replicas)
             desired_count = replicaset.replicas
 
             # Scale up
             if current_count < desired_count:
+                replica_spec = self._replica_spec(replicaset)
+                if replica_spec is None:
+                    continue
                 for i in range(current_count, desired_count):
                     replica_name = f"{replicaset.name}-{i}"
                     print(f"Creating replica: {replica_name}")
                     replica = ContainerResource(
                         name=replica_name,
-                        spec=replicaset.container_spec.copy(),
+                        spec=replica_spec,
                         metadata={"replicaset": replicaset.name},
                     )
-                    self.store.create(replica)
+                    creates.append(replica)
 
             # Scale down
             elif current_count > desired_count:
                 for i in range(desired_count, current_count):
                     replica_name = f"{replicaset.name}-{i}"
                     print(f"Deleting replica: {replica_name}")
-                    self.store.delete("Container", replica_name)
+                    deletes.append(replica_name)
+
+        # Delete replicas whose ReplicaSet no longer exists
+        replicasets = {r.name for r in resources}
+        for owner in self.store.owners("Container"):
+            if owner in replicasets:
+                continue
+            for container in self.store.list_owned("Container", owner):
+                print(f"Deleting orphaned replica: {container.name}")
+                deletes.append(container.name)
+
+        if creates:
+            self.store.create_many(creates)
+        if deletes:
+            self.store.delete_many("Container", deletes)
 
 
 class ServiceController(Controller):
     """Controller for Service resources"""
 
-    def __init__(self, store: ResourceStore):
-        self.state: dict[str, list[str]] = {}
-        super().__init__("Service", store)
+    def __init__(
+        self,
+        store: ResourceStore,
+        container_controller: ContainerController,
+        scheduler: Optional[Scheduler] = None,
+    ):
+        # Digest of the sorted hosts each load balancer was last configured with,
+        # or None while it has been created but not yet configured
+        self.state: dict[str, Optional[int]] = {}
+        # Matching container names by service, replaced wholesale each reconcile
+        # so the API can read it without locking
+        self.matches: Dict[str, List[str]] = {}
+        # Per service: the (Container version, selector) its matches were
+        # computed for, and the sorted hosts and their digest
+        self._matched: Dict[str, Tuple[Tuple[int, str], List[str], int]] = {}
+        # Load balancer IPs come from the container controller's address map
+        self.container_controller = container_controller
+        # Kept open across reconciles so load balancer connections are reused
+        self._http = httpx.Client(timeout=5.0)
+        super().__init__("Service", store, watches=["Container"], scheduler=scheduler)
 
     def reconcile(self, resources: list[Resource]):
         """Validate service selectors"""
         visited_services = set()
+        all_matches: Dict[str, List[str]] = {}
+        all_matched: Dict[str, Tuple[Tuple[int, str], List[str], int]] = {}
+        # Read before listing, so a change made meanwhile forces a recompute
+        containers_version = self.store.versions["Container"]
         for service in resources:
             assert isinstance(service, ServiceResource)
             visited_services.add(service.name)
             # Just validate that the selector matches at least one container
-            containers = self.store.list("Container")
             # TODO: in k8s we use label=value, not name=glob
-            matches = [
-                c.name for c in containers if fnmatch.fnmatch(c.name, service.selector)
-            ]
+            key = (containers_version, service.selector)
+            matched = self._matched.get(service.name)
+            if matched is not None and matched[0] == key:
+                # No container changed since the last match: reuse it
+                matches = self.matches[service.name]
+                _, hosts, digest = matched
+            else:
+                matches = [
+                    c.name
+                    for c in self.store.list("Container", selector=service.selector)
+                ]
+                hosts = sorted(matches)
+                digest = hash(tuple(hosts))
+            all_matches[service.name] = matches
+            all_matched[service.name] = (key, hosts, digest)
             if not matches:
                 print(
                     f"Warning: Service {service.name} selector '{service.selector}' matches no containers"
                 )
-            if self.state.get(service.name) != matches:
+            if self.state.get(service.name) != digest:
                 if service.name not in self.state:
                     self.store.create(
                         ContainerResource(
@@ -403,34 +919,57 @@ class ServiceController(Controller):
                             metadata={},
                         )
                     )
-                    self.state[service.name] = []
+                    self.state[service.name] = None
                 else:
+                    ip = self.container_controller.ips.get(service.loadbalancer_name)
+                    if not ip:
+                        print(f"Service {service.name} load balancer not running yet")
+                        self.requeue()
+                        continue
                     try:
-                        output = subprocess.check_output(
-                            ["docker", "inspect", service.loadbalancer_name], text=True
-                        )
-                        ip = json.loads(output)[0]["NetworkSettings"]["Networks"][
-                            "k4s"
-                        ]["IPAddress"]
                         url = f"http://{ip}:9999/config"
                         print(f"Configuring {service.name} at {url}")
-                        httpx.post(url, json={"hosts": matches})
-                        self.state[service.name] = matches
+                        self._http.post(url, json={"hosts": hosts})
+                        self.state[service.name] = digest
                     except Exception as e:
                         print(
                             f"Service {service.name} container not available so not configuring it (yet): {e}"
                         )
+                        self.requeue()
+        self.matches = all_matches
+        self._matched = all_matched
+
+        # Every visited service is in self.state by now, so equal sizes mean no
+        # service was deleted
+        if len(self.state) != len(visited_services):
+            for service_name in [n for n in self.state if n not in visited_services]:
+                print(f"Deleting load balancer of removed service {service_name}")
+                self.store.delete("Container", loadbalancer_name(service_name))
+                del self.state[service_name]
 
-        for service_name in set(self.state) - visited_services:
-            self.store.delete("Resource", loadbalancer_name(service_name))
+    def stop(self):
+        """Stop the controller, then close its HTTP client"""
+        super().stop()
+        self._http.close()
 
 
 class KissAPI:
     """API for interacting with containers"""
 
-    def __init__(self, container_controller: ContainerController, store: ResourceStore):
+    def __init__(
+        self,
+        container_controller: ContainerController,
+        store: ResourceStore,
+        service_controller: Optional["ServiceController"] = None,
+    ):
         self.container_controller = container_controller
         self.store = store
+        self.service_controller = service_controller
+        # Round-robin position per service; next() on a count is atomic
+        self._rr: Dict[str, Iterator[int]] = {}
+        # Per service: the matched names and container version its running
+        # containers were resolved from, and the result
+        self._resolved: Dict[str, Tuple[List[str], int, List[Container]]] = {}
 
     def send_to_container(
         self, container_name: str, value: Any, expect_response: bool = False
@@ -440,39 +979,95 @@ class KissAPI:
         if not container:
             raise ValueError(f"Container {container_name} not found")
 
-        if expect_response:
-            future = Future()
-            container.input_queue.put((value, future))
-            return future
-        else:
-            container.input_queue.put(value)
-            return None
+        return self._put(container, value, expect_response)
+
+    def send_paced(
+        self, container_name: str, values: Iterable[Any], rate_hz: float
+    ) -> None:
+        """Send values to a container at no more than rate_hz messages per second.
+
+        Only sleeps when ahead of schedule, so slow sends are not delayed further.
+        """
+        period = 1 / rate_hz
+        deadline = time.monotonic()
+        for value in values:
+            delay = deadline - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            self.send_to_container(container_name, value)
+            deadline += period
 
     def send_to_service(
         self, service_name: str, value: Any, expect_response: bool = False
     ) -> Optional[Future]:
-        """Send a value to a random container matched by the service"""
-        service = self.store.get("Service", service_name)
-        if not service:
-            raise ValueError(f"Service {service_name} not found")
+        """Send a value to the next container matched by the service"""
+        matches = self._service_matches(service_name)
+
+        # Round-robin load balancing
+        i = next(self._round_robin(service_name))
+        return self._put(matches[i % len(matches)], value, expect_response)
+
+    def send_many_to_service(
+        self, service_name: str, values: Iterable[Any], expect_response: bool = False
+    ) -> List[Optional[Future]]:
+        """Send each value to the next container matched by the service.
+
+        The selector is resolved once for the whole batch.
+        """
+        matches = self._service_matches(service_name)
+        counter = self._round_robin(service_name)
+        return [
+            self._put(matches[next(counter) % len(matches)], value, expect_response)
+            for value in values
+        ]
+
+    def _round_robin(self, service_name: str) -> Iterator[int]:
+        counter = self._rr.get(service_name)
+        if counter is None:
+            counter = self._rr.setdefault(service_name, itertools.count())
+        return counter
+
+    def _service_matches(self, service_name: str) -> List[Container]:
+        """Find running containers matching the service selector"""
+        names = None
+        if self.service_controller is not None:
+            names = self.service_controller.matches.get(service_name)
+        if names is not None:
+            # Use the names the service controller already matched, resolving
+            # them again only if they or the running containers have changed.
+            # The read lock keeps version and the container map consistent.
+            controller = self.container_controller
+            with controller.lock.read():
+                version = controller.version
+                resolved = self._resolved.get(service_name)
+                if resolved and resolved[0] is names and resolved[1] == version:
+                    matches = resolved[2]
+                else:
+                    containers = controller.containers
+                    matches = [c for c in map(containers.get, names) if c is not None]
+                    self._resolved[service_name] = (names, version, matches)
+        else:
+            # Not reconciled yet: match the selector ourselves
+            service = self.store.get("Service", service_name)
+            if not service:
+                raise ValueError(f"Service {service_name} not found")
 
-        # Find containers matching the service selector
-        containers = self.container_controller.list_containers()
-        matches = [c for c in containers if fnmatch.fnmatch(c.name, service.selector)]
+            match = service.selector_pattern.match
+            containers = self.container_controller.list_containers()
+            matches = [c for c in containers if match(c.name)]
 
         if not matches:
             raise ValueError(f"No containers match service {service_name}")
+        return matches
 
-        # Random load balancing
-        container = random.choice(matches)
-
-        if expect_response:
-            future = Future()
-            container.input_queue.put((value, future))
-            return future
-        else:
-            container.input_queue.put(value)
-            return None
+    def _put(
+        self, container: Container, value: Any, expect_response: bool
+    ) -> Optional[Future]:
+        # Workers always receive (value, future), with future None for
+        # fire-and-forget messages
+        future = Future() if expect_response else None
+        container.input_queue.put((value, future))
+        return future
 
 
 class KissCluster:
@@ -486,24 +1081,43 @@ class KissCluster:
         self.replicaset_controller = None
         self.service_controller = None
         self.api = None
+        # One thread runs every controller's reconciles
+        self.scheduler = Scheduler()
+        self.docker = None
+        self.network = None
 
     def start(self):
         """Start the cluster"""
+        # One client for all docker calls, so its daemon connection is reused
+        self.docker = docker.from_env()
+
         # Initialize API
-        self.container_controller = ContainerController(self.store, None)
+        self.container_controller = ContainerController(
+            self.store, None, self.docker, scheduler=self.scheduler
+        )
         self.api = KissAPI(self.container_controller, self.store)
         self.container_controller.api_client = self.api
 
         # Initialize controllers
-        self.replicaset_controller = ReplicaSetController(self.store)
-        self.service_controller = ServiceController(self.store)
+        self.replicaset_controller = ReplicaSetController(
+            self.store, scheduler=self.scheduler
+        )
+        self.service_controller = ServiceController(
+            self.store, self.container_controller, scheduler=self.scheduler
+        )
+        self.api.service_controller = self.service_controller
 
-        subprocess.check_call(["docker", "network", "create", self.network_name])
+        self.network = self.docker.networks.create(self.network_name)
 
-        # Start controllers
-        self.replicaset_controller.start()
-        self.container_controller.start()
-        self.service_controller.start()
+        # Controllers start on the first resource of their kind; only start
+        # the ones with resources applied before the cluster was started
+        for controller in (
+            self.replicaset_controller,
+            self.container_controller,
+            self.service_controller,
+        ):
+            if self.store.names(controller.kind):
+                controller.start()
 
         print("Cluster started")
 
@@ -515,13 +1129,20 @@ class KissCluster:
             self.replicaset_controller.stop()
         if self.service_controller:
             self.service_controller.stop()
-        subprocess.check_call(["docker", "network", "rm", self.network_name])
+        self.scheduler.stop()
+        if self.network:
+            self.network.remove()
+        if self.docker:
+            self.docker.close()
         print("Cluster stopped")
 
     def apply_yaml(self, yaml_content: str):
         """Apply a YAML resource definition"""
-        docs = yaml.safe_load_all(yaml_content)
+        self.apply_resources(_parse_manifest(yaml_content))
 
+    def apply_resources(self, docs: Iterable[Optional[Dict[str, Any]]]):
+        """Apply already-parsed resource definitions, skipping YAML entirely"""
+        resources = []
         for doc in docs:
             if not doc:
                 continue
@@ -545,18 +1166,48 @@ class KissCluster:
             else:
                 print(f"Unknown resource kind: {kind}")
                 continue
+            resources.append(resource)
 
-            # Create or update
-            try:
-                if self.store.get(kind, name):
-                    self.store.update(resource)
-                    print(f"Updated {kind}: {name}")
-                else:
-                    self.store.create(resource)
-                    print(f"Created {kind}: {name}")
-            except Exception:
-                print("Error applying resource:")
-                traceback.print_exc()
+        # Create or update the whole manifest at once
+        created = self.store.upsert_many(resources)
+        for resource, was_created in zip(resources, created):
+            action = "Created" if was_created else "Updated"
+            print(f"{action} {resource.kind}: {resource.name}")
+
+    def wait_for(self, predicate: Callable[[], bool], timeout: float = 10):
+        """Wait until predicate holds, re-checking after each container reconcile.
+
+        Raises TimeoutError if it still doesn't hold after timeout seconds.
+        """
+        if not self.container_controller.wait_for(predicate, timeout):
+            raise TimeoutError(f"Condition not met within {timeout}s")
+
+    def wait_ready(self, *names: str, timeout: float = 10):
+        """Wait until the named containers are running, or raise TimeoutError"""
+
+        def ready():
+            return all(map(self._is_running, names))
+
+        if not self.container_controller.wait_for(ready, timeout):
+            pending = [n for n in names if not self._is_running(n)]
+            raise TimeoutError(
+                f"Containers not running within {timeout}s: {', '.join(pending)}"
+            )
+
+    def _is_running(self, name: str) -> bool:
+        container = self.container_controller.get_container(name)
+        return container is not None and container.running
+
+    def delete_yaml(self, yaml_content: str):
+        """Delete the resources defined in a YAML document"""
+        for doc in _parse_manifest(yaml_content):
+            if not doc:
+                continue
+
+            kind = doc.get("kind")
+            name = doc.get("metadata", {}).get("name")
+            if kind and name:
+                self.delete_resource(kind, name)
 
     def delete_resource(self, kind: str, name: str):
         """Delete a resource"""
@@ -569,13 +1220,47 @@ class KissCluster:
         """Get a resource"""
         return self.store.get(kind, name)
 
-    def list_resources(self, kind: str) -> List[Resource]:
-        """List resources"""
-        return self.store.list(kind)
+    def list_resources(
+        self,
+        kind: str,
+        name_prefix: Optional[str] = None,
+        selector: Optional[str] = None,
+    ) -> Tuple[Resource, ...]:
+        """List resources, optionally filtered by name prefix or glob selector"""
+        return self.store.list(kind, name_prefix=name_prefix, selector=selector)
+
+    def list_names(
+        self, kind: str, name_prefix: Optional[str] = None
+    ) -> Tuple[str, ...]:
+        """List resource names, optionally filtered by name prefix"""
+        return self.store.names(kind, name_prefix=name_prefix)
+
+
+@functools.lru_cache(maxsize=64)
+def _parse_manifest(yaml_content: str) -> tuple:
+    """Parse a multi-document manifest, reusing the result for repeated applies.
+
+    The returned documents are shared between callers, so they are frozen.
+    """
+    # Documents are parsed serially on purpose: libyaml holds the GIL while
+    # constructing Python objects, so a thread pool over documents is slower.
+    return tuple(map(_freeze, yaml.load_all(yaml_content, Loader=SafeLoader)))
+
+
+def _freeze(value: Any) -> Any:
+    """Make parsed YAML read-only: mappings become views, lists tuples"""
+    if isinstance(value, dict):
+        return types.MappingProxyType({k: _freeze(v) for k, v in value.items()})
+    if isinstance(value, list):
+        return tuple(map(_freeze, value))
+    return value
+
+
+# Characters that make a selector a glob rather than a plain name
+_GLOB_CHARS = frozenset("*?[")
 
 
-def flatten(sublists: Iterable[Iterable]) -> list:
-    results = []
-    for sub in sublists:
-        results += sub
-    return results
+@functools.lru_cache(maxsize=512)
+def _compiled_selector(selector: str) -> re.Pattern:
+    """Compile a glob selector once, for matching against many names"""
+    return re.compile(fnmatch.translate(selector))
@@ -7,8 +7,9 @@ A minimal load balancer with two ports:
 """
 
 import asyncio
+import itertools
 import os
-from typing import List
+from typing import Iterator, List, Tuple
 from fastapi import FastAPI
 from uvicorn.config import Config
 from uvicorn.server import Server
@@ -17,12 +18,15 @@ from uvicorn.server import Server
 CONFIG_PORT = 9999
 SOURCE_PORT = int(os.getenv("SOURCE_PORT", "9000"))
 TARGET_PORT = int(os.getenv("TARGET_PORT", "8000"))
+# Bytes relayed per read, and the most a StreamReader buffers before pausing
+READ_CHUNK = 64 * 1024
+STREAM_LIMIT = 2**20
 
 app = FastAPI()
 
-# Shared state
-backends: List[str] = []
-current_index = 0
+# Shared state, replaced wholesale on every config update
+backends: Tuple[str, ...] = ()
+_picker: Iterator[str] = iter(())
 
 
 @app.post("/config")
@@ -32,9 +36,9 @@ async def update_config(hosts: List[str]):
     Example: ["backend1.local", "backend2.local"]
     All backends use TARGET_PORT from environment.
     """
-    global backends
-    backends.clear()
-    backends.extend(hosts)
+    global backends, _picker
+    backends = tuple(hosts)
+    _picker = itertools.cycle(backends)
     return {"status": "updated", "backends": hosts, "target_port": TARGET_PORT}
 
 
@@ -46,14 +50,7 @@ async def get_config():
 
 def get_next_backend():
     """Get next backend hostname using round-robin"""
-    global current_index
-
-    if not backends:
-        return None
-
-    backend = backends[current_index]
-    current_index = (current_index + 1) % len(backends)
-    return backend
+    return next(_picker, None)
 
 
 async def proxy_connection(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
@@ -68,14 +65,14 @@ async def proxy_connection(reader: asyncio.StreamReader, writer: asyncio.StreamW
     try:
         # Connect to backend using TARGET_PORT
         backend_reader, backend_writer = await asyncio.open_connection(
-            host, TARGET_PORT
+            host, TARGET_PORT, limit=STREAM_LIMIT
         )
 
         # Bidirectional relay
         async def forward(src, dst):
             try:
                 while True:
-                    data = await src.read(8192)
+                    data = await src.read(READ_CHUNK)
                     if not data:
                         break
                     dst.write(data)
@@ -98,7 +95,9 @@ async def proxy_connection(reader: asyncio.StreamReader, writer: asyncio.StreamW
 
 async def run_tcp_server(port: int):
     """Run the TCP proxy server"""
-    server = await asyncio.start_server(proxy_connection, "0.0.0.0", port)
+    server = await asyncio.start_server(
+        proxy_connection, "0.0.0.0", port, limit=STREAM_LIMIT
+    )
     print(f"TCP proxy listening on port {port} (SOURCE_PORT)")
     print(f"Forwarding to backends on port {TARGET_PORT} (TARGET_PORT)")
 
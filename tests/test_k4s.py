@@ -0,0 +1,639 @@
+"""
+Tests for the store, locking and scheduling parts of k4s, none of which need
+Docker. Run with: python -m unittest discover tests
+"""
+
+import contextlib
+import io
+import threading
+import time
+import unittest
+from unittest import mock
+
+import k4s
+from k4s import (
+    Container,
+    ContainerController,
+    ContainerResource,
+    Controller,
+    KissAPI,
+    ReplicaSetController,
+    ReplicaSetResource,
+    ResourceStore,
+    RWLock,
+    Scheduler,
+    ServiceController,
+    ServiceResource,
+)
+
+# Generous bound on how long a thread may take to get somewhere it should reach
+WAIT = 2
+
+
+def quietly():
+    """Swallow the controllers' progress prints"""
+    return contextlib.redirect_stdout(io.StringIO())
+
+
+class RWLockTest(unittest.TestCase):
+    def test_readers_share(self):
+        lock = RWLock()
+        inside = threading.Barrier(2, timeout=WAIT)
+
+        def reader():
+            with lock.read():
+                # Both readers must be inside at once to pass the barrier
+                inside.wait()
+
+        threads = [threading.Thread(target=reader) for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(WAIT)
+            self.assertFalse(thread.is_alive())
+
+    def test_writer_excludes_readers(self):
+        lock = RWLock()
+        entered = threading.Event()
+
+        def reader():
+            with lock.read():
+                entered.set()
+
+        with lock.write():
+            thread = threading.Thread(target=reader)
+            thread.start()
+            self.assertFalse(entered.wait(0.1))
+        self.assertTrue(entered.wait(WAIT))
+        thread.join(WAIT)
+
+    def test_readers_exclude_writer(self):
+        lock = RWLock()
+        entered = threading.Event()
+
+        def writer():
+            with lock.write():
+                entered.set()
+
+        with lock.read():
+            thread = threading.Thread(target=writer)
+            thread.start()
+            self.assertFalse(entered.wait(0.1))
+        self.assertTrue(entered.wait(WAIT))
+        thread.join(WAIT)
+
+    def test_waiting_writer_holds_off_new_readers(self):
+        lock = RWLock()
+        order = []
+
+        def writer():
+            with lock.write():
+                order.append("writer")
+
+        def reader():
+            with lock.read():
+                order.append("reader")
+
+        with lock.read():
+            writer_thread = threading.Thread(target=writer)
+            writer_thread.start()
+            while not lock._writers_waiting:
+                time.sleep(0.001)
+            reader_thread = threading.Thread(target=reader)
+            reader_thread.start()
+            time.sleep(0.1)
+            self.assertEqual(order, [])
+        writer_thread.join(WAIT)
+        reader_thread.join(WAIT)
+        self.assertEqual(order, ["writer", "reader"])
+
+    def test_nested_reads_without_waiting_writer(self):
+        # Reads nest as long as no writer is queued; writes never nest
+        lock = RWLock()
+        with lock.read():
+            with lock.read():
+                self.assertEqual(lock._readers, 2)
+        self.assertEqual(lock._readers, 0)
+
+    def test_released_on_exception(self):
+        lock = RWLock()
+        with self.assertRaises(ValueError):
+            with lock.write():
+                raise ValueError
+        with self.assertRaises(ValueError):
+            with lock.read():
+                raise ValueError
+        self.assertFalse(lock._writer)
+        self.assertEqual(lock._readers, 0)
+
+
+class FakeController:
+    """Stands in for a Controller on the scheduler, recording its passes"""
+
+    def __init__(self, name, log, delays=()):
+        self.name = name
+        self.log = log
+        # Delay to return from each pass in turn, then None
+        self.delays = list(delays)
+
+    def _reconcile_pass(self):
+        self.log.append(self.name)
+        return self.delays.pop(0) if self.delays else None
+
+
+class SchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self.scheduler = Scheduler()
+        self.addCleanup(self.scheduler.stop)
+        self.log = []
+
+    def wait_for_log(self, length):
+        deadline = time.monotonic() + WAIT
+        while len(self.log) < length and time.monotonic() < deadline:
+            time.sleep(0.005)
+
+    def test_runs_soonest_due_first(self):
+        for name, delay in [("c", 0.15), ("a", 0), ("b", 0.05)]:
+            self.scheduler.schedule(FakeController(name, self.log), delay)
+        self.scheduler.start()
+        self.wait_for_log(3)
+        self.assertEqual(self.log, ["a", "b", "c"])
+
+    def test_keeps_earliest_due_per_controller(self):
+        controller = FakeController("a", self.log)
+        self.scheduler.schedule(controller, 0.05)
+        self.scheduler.schedule(controller, 10)
+        self.scheduler.schedule(controller, 0)
+        self.scheduler.start()
+        self.wait_for_log(1)
+        time.sleep(0.1)
+        self.assertEqual(self.log, ["a"])
+
+    def test_reschedules_with_returned_delay(self):
+        controller = FakeController("a", self.log, delays=[0.01, 0.01])
+        self.scheduler.start()
+        self.scheduler.schedule(controller)
+        self.wait_for_log(3)
+        time.sleep(0.05)
+        self.assertEqual(self.log, ["a", "a", "a"])
+
+    def test_cancel_drops_pending_pass(self):
+        controller = FakeController("a", self.log)
+        self.scheduler.schedule(controller, 0.05)
+        self.scheduler.cancel(controller)
+        self.scheduler.start()
+        time.sleep(0.1)
+        self.assertEqual(self.log, [])
+
+
+class RequeueController(Controller):
+    def __init__(self, store, requeue):
+        super().__init__("Container", store, scheduler=Scheduler())
+        self.running = True
+        self.should_requeue = requeue
+
+    def reconcile(self, resources):
+        if self.should_requeue:
+            self.requeue()
+
+
+class ControllerPassTest(unittest.TestCase):
+    def test_requeue_retries_soon(self):
+        controller = RequeueController(ResourceStore(), requeue=True)
+        self.assertEqual(controller._reconcile_pass(), k4s.RETRY_PERIOD)
+
+    def test_resyncs_only_with_resources(self):
+        store = ResourceStore()
+        controller = RequeueController(store, requeue=False)
+        self.assertIsNone(controller._reconcile_pass())
+        store.create(ContainerResource("a", {"image": "x"}))
+        self.assertEqual(controller._reconcile_pass(), k4s.RESYNC_PERIOD)
+
+
+class StoreUpsertTest(unittest.TestCase):
+    def setUp(self):
+        self.store = ResourceStore()
+
+    def test_upsert_many_reports_created_and_notifies_once_per_kind(self):
+        self.store.create(ContainerResource("a", {"image": "old"}))
+        notified = []
+        self.store.watch("Container", lambda: notified.append("Container"))
+        self.store.watch("Service", lambda: notified.append("Service"))
+        created = self.store.upsert_many(
+            [
+                ContainerResource("a", {"image": "new"}),
+                ContainerResource("b", {"image": "x"}),
+                ServiceResource("s", {"selector": "a"}),
+            ]
+        )
+        self.assertEqual(created, [False, True, True])
+        self.assertEqual(self.store.get("Container", "a").image, "new")
+        self.assertEqual(sorted(notified), ["Container", "Service"])
+
+
+class RecordingRWLock(RWLock):
+    """RWLock that logs its kind whenever its write side is taken"""
+
+    def __init__(self, kind, log):
+        super().__init__()
+        self.kind = kind
+        self.log = log
+
+    def write(self):
+        self.log.append(self.kind)
+        return super().write()
+
+
+class StoreLockOrderTest(unittest.TestCase):
+    def setUp(self):
+        self.store = ResourceStore()
+
+    def test_upsert_many_locks_kinds_once_in_sorted_order(self):
+        log = []
+        for kind in self.store.locks:
+            self.store.locks[kind] = RecordingRWLock(kind, log)
+        self.store.upsert_many(
+            [
+                ServiceResource("s", {"selector": "a"}),
+                ContainerResource("a", {"image": "x"}),
+                ReplicaSetResource("r", {"spec": {"image": "x"}}),
+                ContainerResource("b", {"image": "x"}),
+            ]
+        )
+        self.assertEqual(log, ["Container", "ReplicaSet", "Service"])
+
+    def test_concurrent_upserts_in_opposite_orders_finish(self):
+        forward = [
+            ContainerResource("a", {"image": "x"}),
+            ServiceResource("s", {"selector": "a"}),
+        ]
+        backward = forward[::-1]
+
+        def apply(resources):
+            for _ in range(200):
+                self.store.upsert_many(resources)
+
+        threads = [
+            threading.Thread(target=apply, args=(resources,), daemon=True)
+            for resources in (forward, backward)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(WAIT * 5)
+            self.assertFalse(thread.is_alive())
+
+
+class StoreBatchTest(unittest.TestCase):
+    def setUp(self):
+        self.store = ResourceStore()
+
+    def test_create_many_is_all_or_none(self):
+        self.store.create(ContainerResource("b", {"image": "x"}))
+        with self.assertRaises(ValueError):
+            self.store.create_many(
+                [
+                    ContainerResource("a", {"image": "x"}),
+                    ContainerResource("b", {"image": "x"}),
+                ]
+            )
+        self.assertEqual(self.store.names("Container"), ("b",))
+
+    def test_create_many_needs_one_kind(self):
+        with self.assertRaises(ValueError):
+            self.store.create_many(
+                [
+                    ContainerResource("a", {"image": "x"}),
+                    ServiceResource("s", {"selector": "a"}),
+                ]
+            )
+
+    def test_delete_many_counts_existing(self):
+        self.store.create_many(
+            [ContainerResource(name, {"image": "x"}) for name in ("a", "b")]
+        )
+        self.assertEqual(self.store.delete_many("Container", ["a", "missing"]), 1)
+        self.assertEqual(self.store.names("Container"), ("b",))
+
+
+class StoreListFilterTest(unittest.TestCase):
+    def setUp(self):
+        self.store = ResourceStore()
+
+    def test_filtered_lists(self):
+        self.store.create_many(
+            [ContainerResource(name, {"image": "x"}) for name in ("a-0", "a-1", "b")]
+        )
+        names = lambda resources: [r.name for r in resources]
+        self.assertEqual(
+            names(self.store.list("Container", selector="a-*")), ["a-0", "a-1"]
+        )
+        self.assertEqual(names(self.store.list("Container", selector="b")), ["b"])
+        self.assertEqual(
+            names(self.store.list("Container", name_prefix="a-")), ["a-0", "a-1"]
+        )
+
+
+class StoreSnapshotTest(unittest.TestCase):
+    def setUp(self):
+        self.store = ResourceStore()
+
+    def assertSnapshotCurrent(self):
+        for kind, resources in self.store.resources.items():
+            self.assertEqual(self.store.list(kind), tuple(resources.values()))
+
+    def test_snapshot_follows_every_mutation(self):
+        store = self.store
+        self.assertEqual(store.list("Container"), ())
+        store.create(ContainerResource("a", {"image": "x"}))
+        self.assertSnapshotCurrent()
+        store.create_many(
+            [ContainerResource(name, {"image": "x"}) for name in ("b", "c")]
+        )
+        self.assertSnapshotCurrent()
+        store.update(ContainerResource("a", {"image": "y"}))
+        self.assertSnapshotCurrent()
+        self.assertEqual(store.list("Container")[0].image, "y")
+        store.upsert_many(
+            [ContainerResource("d", {"image": "x"}), ServiceResource("s", {})]
+        )
+        self.assertSnapshotCurrent()
+        store.delete("Container", "b")
+        self.assertSnapshotCurrent()
+        store.delete_many("Container", ["a", "c"])
+        self.assertSnapshotCurrent()
+        self.assertEqual([r.name for r in store.list("Container")], ["d"])
+
+    def test_snapshot_is_shared_until_changed(self):
+        self.store.create(ContainerResource("a", {"image": "x"}))
+        snapshot = self.store.list("Container")
+        self.assertIs(self.store.list("Container"), snapshot)
+        self.store.create(ContainerResource("b", {"image": "x"}))
+        self.assertIsNot(self.store.list("Container"), snapshot)
+        self.assertEqual(len(snapshot), 1)
+
+    def test_unknown_kind_lists_empty(self):
+        self.assertEqual(self.store.list("Nope"), ())
+
+
+class ContainerSnapshotTest(unittest.TestCase):
+    def test_snapshot_tracks_running_containers(self):
+        controller = ContainerController(ResourceStore(), mock.Mock(), mock.Mock())
+        self.addCleanup(controller.pool.shutdown)
+        resources = [ContainerResource(name, {"image": "x"}) for name in "ab"]
+        with (
+            mock.patch.object(Container, "start"),
+            mock.patch.object(Container, "stop"),
+            quietly(),
+        ):
+            controller.reconcile(resources)
+            self.assertEqual(
+                sorted(c.name for c in controller.list_containers()), ["a", "b"]
+            )
+            version = controller.version
+            controller.reconcile(resources[:1])
+            self.assertEqual([c.name for c in controller.list_containers()], ["a"])
+            self.assertGreater(controller.version, version)
+            controller.reconcile([])
+            self.assertEqual(controller.list_containers(), ())
+
+
+class ContainerStopRetryTest(unittest.TestCase):
+    def setUp(self):
+        self.controller = ContainerController(ResourceStore(), mock.Mock(), mock.Mock())
+        self.addCleanup(self.controller.pool.shutdown)
+        self.stop_error = None
+        stack = contextlib.ExitStack()
+        self.addCleanup(stack.close)
+        stack.enter_context(mock.patch.object(Container, "start"))
+        stack.enter_context(mock.patch.object(Container, "stop", side_effect=self.stop))
+        stack.enter_context(quietly())
+
+    def stop(self):
+        if self.stop_error is not None:
+            raise self.stop_error
+
+    def reconcile(self, *names):
+        self.controller.reconcile(
+            [ContainerResource(name, {"image": "x"}) for name in names]
+        )
+
+    def running(self):
+        return sorted(c.name for c in self.controller.list_containers())
+
+    def test_failed_stop_is_not_published(self):
+        self.reconcile("a")
+        version = self.controller.version
+        self.stop_error = OSError("busy")
+        with self.assertRaises(RuntimeError):
+            self.reconcile("b")
+        self.assertEqual(self.running(), ["b"])
+        self.assertIsNone(self.controller.get_container("a"))
+        self.assertEqual(self.controller.version, version + 2)
+
+    def test_failed_stop_is_retried(self):
+        self.reconcile("a")
+        self.stop_error = OSError("busy")
+        with self.assertRaises(RuntimeError):
+            self.reconcile()
+        with self.assertRaises(RuntimeError):
+            self.reconcile()
+        self.stop_error = None
+        self.reconcile()
+        self.assertEqual(Container.stop.call_count, 3)
+        self.assertEqual(self.running(), [])
+
+    def test_recreated_container_starts_once_old_one_is_removed(self):
+        self.reconcile("a")
+        self.stop_error = OSError("busy")
+        with self.assertRaises(RuntimeError):
+            self.reconcile()
+        # Wanted again while its old container is still being removed
+        with self.assertRaises(RuntimeError):
+            self.reconcile("a")
+        self.assertEqual(self.running(), [])
+        self.stop_error = None
+        self.reconcile("a")
+        self.assertEqual(self.running(), ["a"])
+
+
+class ReplicaSetOrphanTest(unittest.TestCase):
+    def test_deletes_replicas_of_removed_replicasets(self):
+        store = ResourceStore()
+        store.create(ReplicaSetResource("kept", {"spec": {"image": "x"}}))
+        store.create_many(
+            [
+                ContainerResource("kept-0", {"image": "x"}, {"replicaset": "kept"}),
+                ContainerResource("gone-0", {"image": "x"}, {"replicaset": "gone"}),
+                ContainerResource("gone-1", {"image": "x"}, {"replicaset": "gone"}),
+                ContainerResource("solo", {"image": "x"}),
+            ]
+        )
+        controller = ReplicaSetController(store)
+        self.addCleanup(controller.scheduler.stop)
+        # Orphans come from the owner index, not a scan of every container
+        with mock.patch.object(store, "list", wraps=store.list) as listing, quietly():
+            controller.reconcile(store.list("ReplicaSet"))
+        self.assertNotIn(mock.call("Container"), listing.call_args_list)
+        self.assertEqual(store.names("Container"), ("kept-0", "solo"))
+        self.assertEqual(store.owners("Container"), ("kept",))
+
+
+class ServiceSendTest(unittest.TestCase):
+    def setUp(self):
+        store = ResourceStore()
+        self.controller = ContainerController(store, mock.Mock(), mock.Mock())
+        self.addCleanup(self.controller.pool.shutdown)
+        services = mock.Mock()
+        services.matches = {"web": ["web-0", "web-1"]}
+        self.api = KissAPI(self.controller, store, services)
+
+    def reconcile(self, *names):
+        with (
+            mock.patch.object(Container, "start"),
+            mock.patch.object(Container, "stop"),
+            quietly(),
+        ):
+            self.controller.reconcile(
+                [ContainerResource(name, {"image": "x"}) for name in names]
+            )
+
+    def matched(self):
+        return [c.name for c in self.api._service_matches("web")]
+
+    def test_resolves_matches_against_running_containers(self):
+        self.reconcile("web-0", "web-1")
+        first = self.api._service_matches("web")
+        self.assertEqual([c.name for c in first], ["web-0", "web-1"])
+        self.assertIs(self.api._service_matches("web"), first)
+        self.reconcile("web-1")
+        self.assertEqual(self.matched(), ["web-1"])
+
+    def test_waits_for_container_map_writers(self):
+        self.reconcile("web-0")
+        resolved = threading.Event()
+
+        def resolve():
+            self.matched()
+            resolved.set()
+
+        with self.controller.lock.write():
+            thread = threading.Thread(target=resolve)
+            thread.start()
+            self.assertFalse(resolved.wait(0.1))
+        self.assertTrue(resolved.wait(WAIT))
+        thread.join(WAIT)
+
+
+class ManifestCacheTest(unittest.TestCase):
+    MANIFEST = """
+kind: ReplicaSet
+metadata:
+  name: web
+spec:
+  spec:
+    image: web
+    env:
+      MODE: fast
+  replicas: 2
+"""
+
+    def test_cached_documents_are_frozen(self):
+        (doc,) = k4s._parse_manifest(self.MANIFEST)
+        self.assertIs(k4s._parse_manifest(self.MANIFEST)[0], doc)
+        with self.assertRaises(TypeError):
+            doc["spec"]["replicas"] = 3
+        with self.assertRaises(TypeError):
+            doc["spec"]["spec"]["env"]["MODE"] = "slow"
+
+    def test_applied_resources_cannot_poison_the_cache(self):
+        cluster = k4s.KissCluster()
+        self.addCleanup(cluster.scheduler.stop)
+        with quietly():
+            cluster.apply_yaml(self.MANIFEST)
+        resource = cluster.get_resource("ReplicaSet", "web")
+        with self.assertRaises(TypeError):
+            resource.spec["replicas"] = 5
+        with self.assertRaises(TypeError):
+            resource.metadata["name"] = "other"
+        self.assertEqual(k4s._parse_manifest(self.MANIFEST)[0]["spec"]["replicas"], 2)
+
+    def test_containers_get_a_plain_environment(self):
+        (doc,) = k4s._parse_manifest(self.MANIFEST)
+        container = Container(
+            "web-0", "web", None, doc["spec"]["spec"]["env"], None, None
+        )
+        self.assertEqual(container.env, {"MODE": "fast"})
+        self.assertIs(type(container.env), dict)
+
+
+class ServiceControllerFixture:
+    """Sets up a ServiceController over a store with one service and two containers"""
+
+    def setUp(self):
+        self.store = ResourceStore()
+        self.store.create_many(
+            [ContainerResource(name, {"image": "x"}) for name in ("web-0", "web-1")]
+        )
+        self.store.create(ServiceResource("web", {"selector": "web-*"}))
+        containers = mock.Mock()
+        containers.ips = {}
+        # Created after the resources, so nothing wakes it behind our back
+        self.controller = ServiceController(self.store, containers)
+        self.controller._http = mock.Mock()
+        self.addCleanup(self.controller.scheduler.stop)
+
+    def reconcile(self):
+        with quietly():
+            self.controller.reconcile(self.store.list("Service"))
+        return self.controller.matches["web"]
+
+
+class LoadBalancerConfigTest(ServiceControllerFixture, unittest.TestCase):
+    def test_configures_load_balancer_once_per_host_set(self):
+        self.reconcile()
+        self.controller.container_controller.ips = {
+            k4s.loadbalancer_name("web"): "10.0.0.2"
+        }
+        self.reconcile()
+        self.reconcile()
+        self.controller._http.post.assert_called_once_with(
+            "http://10.0.0.2:9999/config", json={"hosts": ["web-0", "web-1"]}
+        )
+
+
+class LoadBalancerAddressTest(ServiceControllerFixture, unittest.TestCase):
+    def test_waits_for_load_balancer_ip(self):
+        self.reconcile()
+        self.controller.container_controller.ips = {k4s.loadbalancer_name("web"): ""}
+        self.reconcile()
+        self.controller._http.post.assert_not_called()
+        self.assertTrue(self.controller._retry)
+
+
+class ServiceMatchCacheTest(ServiceControllerFixture, unittest.TestCase):
+    def test_reuses_matches_while_containers_unchanged(self):
+        # The first pass creates the load balancer container, so settle first
+        self.reconcile()
+        first = self.reconcile()
+        self.assertEqual(first, ["web-0", "web-1"])
+        self.assertIs(self.reconcile(), first)
+
+    def test_container_change_invalidates_matches(self):
+        self.reconcile()
+        first = self.reconcile()
+        self.store.create(ContainerResource("web-2", {"image": "x"}))
+        second = self.reconcile()
+        self.assertIsNot(second, first)
+        self.assertEqual(second, ["web-0", "web-1", "web-2"])
+        self.store.delete("Container", "web-0")
+        self.assertEqual(self.reconcile(), ["web-1", "web-2"])
+
+    def test_selector_change_invalidates_matches(self):
+        self.reconcile()
+        self.store.update(ServiceResource("web", {"selector": "web-1"}))
+        self.assertEqual(self.reconcile(), ["web-1"])
+
+
+if __name__ == "__main__":
+    unittest.main()
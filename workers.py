@@ -3,6 +3,9 @@ Example worker modules for the Kiss demo.
 These functions can be deployed as containers.
 """
 
+import math
+import queue
+import statistics
 import time
 import random
 
@@ -25,19 +28,26 @@ def echo_worker(input_queue, api_client, prefix="ECHO"):
         if item is None:
             break
 
-        # Check if this is a request-response pattern
-        if isinstance(item, tuple) and len(item) == 2:
-            value, future = item
+        # Messages are (value, future); future is None for fire-and-forget
+        value, future = item
+        if future is not None:
             response = f"{prefix}: {value}"
             print(f"Echo worker processing request: {value} -> {response}")
             future.set_result(response)
         else:
-            # Just a fire-and-forget message
-            print(f"Echo worker received: {prefix}: {item}")
+            print(f"Echo worker received: {prefix}: {value}")
 
     print(f"Echo worker stopped")
 
 
+# String operations processor_worker can apply, by name
+PROCESSOR_OPERATIONS = {
+    "uppercase": str.upper,
+    "lowercase": str.lower,
+    "reverse": lambda s: s[::-1],
+}
+
+
 def processor_worker(input_queue, api_client, operation="uppercase", forward_to=None):
     """
     Worker that processes strings and optionally forwards results.
@@ -50,34 +60,25 @@ def processor_worker(input_queue, api_client, operation="uppercase", forward_to=
     """
     print(f"Processor worker started with operation: {operation}")
 
+    # Resolve the operation once; unknown operations pass values through
+    apply = PROCESSOR_OPERATIONS.get(operation, str)
+
     while True:
         item = input_queue.get()
 
         if item is None:
             break
 
-        # Handle request-response pattern
-        if isinstance(item, tuple) and len(item) == 2:
-            value, future = item
-        else:
-            value = item
-            future = None
+        value, future = item
 
         # Process the value
         try:
-            if operation == "uppercase":
-                result = str(value).upper()
-            elif operation == "lowercase":
-                result = str(value).lower()
-            elif operation == "reverse":
-                result = str(value)[::-1]
-            else:
-                result = str(value)
+            result = apply(str(value))
 
             print(f"Processor worker: {value} -> {result}")
 
             # Send response if expected
-            if future:
+            if future is not None:
                 future.set_result(result)
 
             # Forward to another container/service if configured
@@ -92,7 +93,7 @@ def processor_worker(input_queue, api_client, operation="uppercase", forward_to=
 
         except Exception as e:
             print(f"Processor worker error: {e}")
-            if future:
+            if future is not None:
                 future.set_exception(e)
 
     print("Processor worker stopped")
@@ -120,30 +121,27 @@ def aggregator_worker(input_queue, api_client, window_size=5):
                 future.set_result(None)
             break
 
-        # Handle request-response pattern
-        if isinstance(item, tuple) and len(item) == 2:
-            value, future = item
+        value, future = item
+        if future is not None:
             futures.append(future)
-        else:
-            value = item
-            future = None
 
         messages.append(value)
         print(f"Aggregator received: {value} (count: {len(messages)})")
 
         # Report when window is full
         if len(messages) >= window_size:
+            # Hand the window itself to the report and start a fresh one
             report = {
                 "count": len(messages),
-                "messages": messages.copy(),
+                "messages": messages,
                 "sample": messages[0] if messages else None,
             }
+            messages = []
             print(f"Aggregator report: {report}")
 
             for future in futures:
                 future.set_result(report)
 
-            messages.clear()
             futures.clear()
 
     print("Aggregator worker stopped")
@@ -181,12 +179,24 @@ def generator_worker(input_queue, api_client, target, interval=2, count=10):
             item = input_queue.get(timeout=0.1)
             if item is None:
                 break
-        except:
+        except queue.Empty:
             pass
 
     print("Generator worker finished")
 
 
+def _average(operands):
+    return statistics.fmean(operands) if operands else 0
+
+
+# Calculations calculator_worker can perform, by name
+CALCULATOR_OPERATIONS = {
+    "sum": sum,
+    "product": math.prod,
+    "average": _average,
+}
+
+
 def calculator_worker(input_queue, api_client):
     """
     Worker that performs calculations on request-response basis.
@@ -204,27 +214,18 @@ def calculator_worker(input_queue, api_client):
             break
 
         # Must be request-response pattern
-        if not isinstance(item, tuple) or len(item) != 2:
+        request, future = item
+        if future is None:
             print("Calculator: ignoring non-request message")
             continue
 
-        request, future = item
-
         try:
             # Request should be dict with 'operation' and 'operands'
             operation = request.get("operation")
             operands = request.get("operands", [])
 
-            if operation == "sum":
-                result = sum(operands)
-            elif operation == "product":
-                result = 1
-                for x in operands:
-                    result *= x
-            elif operation == "average":
-                result = sum(operands) / len(operands) if operands else 0
-            else:
-                result = None
+            calculate = CALCULATOR_OPERATIONS.get(operation)
+            result = calculate(operands) if calculate else None
 
             print(f"Calculator: {operation}({operands}) = {result}")
             future.set_result(result)